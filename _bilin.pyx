@@ -0,0 +1,55 @@
+# cython: boundscheck=False, wraparound=False, cdivision=True, language_level=3
+"""
+Compiled bilinear interpolation of the velocity field on a regular grid.
+
+Used by streamline.py when numba is not available. Compile it in place with:
+    cythonize -i _bilin.pyx
+"""
+from cython cimport floating
+from libc.math cimport floor, isfinite
+
+
+cdef inline Py_ssize_t _locate(double x0, double dx, Py_ssize_t n, double x, double *t) noexcept nogil:
+    # Index of the grid cell containing x (clamped to the grid) and the fractional position within it
+    cdef double f = (x - x0) / dx
+    cdef Py_ssize_t i
+    if f < 0:
+        i = 0
+    elif f > n - 2:
+        i = n - 2
+    else:
+        i = <Py_ssize_t>floor(f)
+    t[0] = f - i
+    return i
+
+
+cdef inline double _bilerp(floating[:, ::1] A, Py_ssize_t i, Py_ssize_t j, double tx, double ty) noexcept nogil:
+    # Bilinear interpolation of A within cell (i, j)
+    return ((1.0 - ty) * ((1.0 - tx) * A[i, j] + tx * A[i, j + 1])
+            + ty * ((1.0 - tx) * A[i + 1, j] + tx * A[i + 1, j + 1]))
+
+
+def velocity(floating[:, ::1] U, floating[:, ::1] V, floating[:, ::1] S,
+             double x0, double dx, double y0, double dy, double x, double y):
+    """
+    Bilinearly interpolated velocity at (x, y) on a regular grid.
+
+    Points outside the grid are extrapolated linearly from the nearest cell. If S is
+    non-empty the velocity is divided by the interpolated S. Returns (0, 0) where the
+    velocity is not finite.
+    """
+    cdef double tx, ty, u, v, s
+    cdef Py_ssize_t i, j
+    if not (isfinite(x) and isfinite(y)):
+        return 0.0, 0.0
+    j = _locate(x0, dx, U.shape[1], x, &tx)
+    i = _locate(y0, dy, U.shape[0], y, &ty)
+    u = _bilerp(U, i, j, tx, ty)
+    v = _bilerp(V, i, j, tx, ty)
+    if S.shape[0] > 0:
+        s = _bilerp(S, i, j, tx, ty)
+        u /= s
+        v /= s
+    if not (isfinite(u) and isfinite(v)):
+        return 0.0, 0.0
+    return u, v
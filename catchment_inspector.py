@@ -12,10 +12,14 @@ import xarray as xr
 import matplotlib.pyplot as plt
 import numpy as np
 import geopandas as gpd
+import shapely
 from matplotlib.colors import Normalize
-from streamline import streamline
+from streamline import streamline, make_interpolators
 import os
 import configparser
+import argparse
+import multiprocessing
+from collections import namedtuple
 import matplotlib
 
 # Change the working directory to the location of this script
@@ -43,20 +47,34 @@ if 'velocity_data' not in config['Paths'] or not config['Paths']['velocity_data'
 
 # Load the shapefile and velocity dataset
 basins = gpd.read_file(config['Paths']['shapefile'])
+# Prepare all polygons once, for fast point in polygon tests
+shapely.prepare(basins.geometry.values)
 velocity_data = xr.open_dataset(config['Paths']['velocity_data']).squeeze()
 
 # Flip y-axis if its in the wrong direction
 if velocity_data.y[0] > velocity_data.y[1]:
     velocity_data = velocity_data.reindex(y=velocity_data.y[::-1])
 
-# Extract velocity components and calculate magnitude
-u = velocity_data['land_ice_surface_easting_velocity']
-v = velocity_data['land_ice_surface_northing_velocity']
-speed = velocity_data['land_ice_surface_velocity_magnitude']
+# Coordinate arrays used to resolve polygon bounds to index slices
+x_coords = velocity_data['x'].values
+y_coords = velocity_data['y'].values
 
-def inspect_basin(n,starting_point=(np.nan,np.nan),speed_threshold=float(config['Processing']['speed_threshold'])):
-    global new_point
-    new_point = starting_point
+# Number of points in each direction of a streamline
+max_points = 10000
+
+def apply_mask(data, mask):
+    """Returns a copy of data that is NaN where mask is False"""
+    masked = np.full(data.shape, np.nan, dtype=data.dtype)
+    np.copyto(masked, data, where=mask)
+    return masked
+
+Basin = namedtuple('Basin', ['name', 'polygon', 'extent', 'x', 'y', 'speed', 'u', 'v', 'interpolators'])
+
+def load_basin(n,speed_threshold=float(config['Processing']['speed_threshold'])):
+    """
+    Subsets and masks the velocity data to the n'th basin.
+    Returns None if there are no speeds over the threshold in the basin.
+    """
     # Access the n'th entry of the GeoDataFrame
     entry = basins.iloc[n]
     polygon = entry.geometry
@@ -64,30 +82,38 @@ def inspect_basin(n,starting_point=(np.nan,np.nan),speed_threshold=float(config[
 
     # Subset the velocity data to the extent of the polygon
     minx, miny, maxx, maxy = polygon.bounds
-    u_subset = u.sel(x=slice(minx, maxx), y=slice(miny, maxy))
-    v_subset = v.sel(x=slice(minx, maxx), y=slice(miny, maxy))
-    speed_subset = speed.sel(x=slice(minx, maxx), y=slice(miny, maxy))
-    # Subset the x and y coordinates to the extent of the polygon
-    x_subset = velocity_data['x'].sel(x=slice(minx, maxx))
-    y_subset = velocity_data['y'].sel(y=slice(miny, maxy))
-
-    # Create a mask for points inside the polygon
-    xv, yv = np.meshgrid(x_subset.data, y_subset.data)
-    points = np.vstack((xv.ravel(), yv.ravel())).T
-    mask_polygon = np.array([polygon.contains(gpd.points_from_xy([p[0]], [p[1]])[0]) for p in points]).reshape(xv.shape)
+    ix = slice(np.searchsorted(x_coords, minx), np.searchsorted(x_coords, maxx, side='right'))
+    iy = slice(np.searchsorted(y_coords, miny), np.searchsorted(y_coords, maxy, side='right'))
+    # Only the velocity fields of the subset are read from disk, in single precision to halve the memory traffic
+    subset = velocity_data[['land_ice_surface_easting_velocity',
+                            'land_ice_surface_northing_velocity',
+                            'land_ice_surface_velocity_magnitude']].isel(x=ix, y=iy).astype(np.float32, copy=False)
+    # Extract velocity components and coordinates of the subset
+    u_subset = subset['land_ice_surface_easting_velocity']
+    v_subset = subset['land_ice_surface_northing_velocity']
+    speed_subset = subset['land_ice_surface_velocity_magnitude']
+    x_subset = subset['x']
+    y_subset = subset['y']
+
+    # Broadcast views of the grid coordinates, no full grid is allocated
+    xv = np.broadcast_to(x_subset.values, (y_subset.size, x_subset.size))
+    yv = np.broadcast_to(y_subset.values[:, None], xv.shape)
     # Create a mask where speeds are over the threshold
-    mask_speed = speed_subset>speed_threshold
-    # Combine the masks
-    mask = mask_polygon & mask_speed
+    mask_speed = (speed_subset > speed_threshold).values
+    # Only test the fast points against the (prepared) polygon
+    mask = np.zeros_like(mask_speed)
+    mask[mask_speed] = shapely.contains_xy(polygon, xv[mask_speed], yv[mask_speed])
 
     # Check if there are speeds over threshold
     if not np.any(mask):
         print('No speeds over {} m pr day for {}'.format(speed_threshold, name))
-        return (np.nan,np.nan)
+        return None
     
     # Create subsets of the data from the bounds of the mask
-    i_bounds = np.where(np.any(mask, axis=1))[0][[0,-1]]
-    j_bounds = np.where(np.any(mask, axis=0))[0][[0,-1]]
+    rows = mask.any(axis=1)
+    cols = mask.any(axis=0)
+    i_bounds = (rows.argmax(), rows.size - 1 - rows[::-1].argmax())
+    j_bounds = (cols.argmax(), cols.size - 1 - cols[::-1].argmax())
     # Determine the extent of the masked region
     extent = [x_subset[j_bounds[0]].item(), x_subset[j_bounds[1]].item(),
               y_subset[i_bounds[0]].item(), y_subset[i_bounds[1]].item()]
@@ -96,28 +122,52 @@ def inspect_basin(n,starting_point=(np.nan,np.nan),speed_threshold=float(config[
     u_subset = u_subset[i_bounds[0]:i_bounds[1], j_bounds[0]:j_bounds[1]]
     v_subset = v_subset[i_bounds[0]:i_bounds[1], j_bounds[0]:j_bounds[1]]
     speed_subset = speed_subset[i_bounds[0]:i_bounds[1], j_bounds[0]:j_bounds[1]]
-    xv = xv[i_bounds[0]:i_bounds[1], j_bounds[0]:j_bounds[1]]
-    yv = yv[i_bounds[0]:i_bounds[1], j_bounds[0]:j_bounds[1]]
     mask = mask[i_bounds[0]:i_bounds[1], j_bounds[0]:j_bounds[1]]
     x_subset = x_subset[j_bounds[0]:j_bounds[1]]
     y_subset = y_subset[i_bounds[0]:i_bounds[1]]
 
 
     # Apply the mask to the speed
-    speed_masked = np.where(mask, speed_subset.data, np.nan)
+    speed_masked = apply_mask(speed_subset.values, mask)
+
+    # Mask the velocity components for streamlines
+    u_stream = apply_mask(u_subset.values, mask)
+    v_stream = apply_mask(v_subset.values, mask)
+    # Build the interpolators once and reuse them for every streamline in this basin
+    interpolators = make_interpolators(x_subset.values, y_subset.values, u_stream, v_stream)
+
+    return Basin(name, polygon, extent, x_subset.values, y_subset.values,
+                 speed_masked, u_stream, v_stream, interpolators)
+
+def compute_streamline(n,starting_point=(np.nan,np.nan),speed_threshold=float(config['Processing']['speed_threshold'])):
+    """
+    Computes the streamline of the n'th basin without plotting.
+    If starting_point is not set the centroid of the polygon is used.
+    Returns the streamline (None if there are no speeds over threshold) and the starting point.
+    """
+    basin = load_basin(n,speed_threshold)
+    if basin is None:
+        return None, (np.nan,np.nan)
+    if np.isnan(starting_point[0]):
+        starting_point = (basin.polygon.centroid.x, basin.polygon.centroid.y)
+    sl = streamline(basin.x, basin.y, basin.u, basin.v,[starting_point[0], starting_point[1]],t_max=1000000,max_points=max_points,interpolators=basin.interpolators)
+    return sl, starting_point
+
+def inspect_basin(n,starting_point=(np.nan,np.nan),speed_threshold=float(config['Processing']['speed_threshold'])):
+    global new_point
+    new_point = starting_point
+    basin = load_basin(n,speed_threshold)
+    if basin is None:
+        return (np.nan,np.nan)
+    name, polygon, extent = basin.name, basin.polygon, basin.extent
+    x, y, u_stream, v_stream, interpolators = basin.x, basin.y, basin.u, basin.v, basin.interpolators
+    speed_masked = basin.speed
 
     # Create figure
     fig, ax = plt.subplots(1,1,figsize=(10,10))
     ax.set_xlim(extent[0], extent[1])
     ax.set_ylim(extent[2], extent[3])
-    mvel = ax.pcolormesh(xv, yv, speed_masked, shading='auto', cmap='viridis', norm=Normalize(vmin=0, vmax=np.nanmax(speed_masked)))
-
-    # Create a grid for streamlines
-    X, Y = np.meshgrid(x_subset, y_subset)
-
-    # Mask the velocity components for streamlines
-    u_stream = np.where(mask, u_subset, np.nan)
-    v_stream = np.where(mask, v_subset, np.nan)
+    mvel = ax.pcolormesh(x, y, speed_masked, shading='auto', cmap='viridis', norm=Normalize(vmin=0, vmax=np.nanmax(speed_masked)))
 
     # Plot the old starting point
     # If there is no saved starting_point set it to the centroid of the polygon
@@ -127,17 +177,35 @@ def inspect_basin(n,starting_point=(np.nan,np.nan),speed_threshold=float(config[
     user_point = ax.plot([], [], 'yo', label='New starting point')
 
     # calculate streamline from old starting point
-    sl = streamline(X, Y, u_stream, v_stream,[new_point[0], new_point[1]],t_max=1000000)
+    sl = streamline(x, y, u_stream, v_stream,[new_point[0], new_point[1]],t_max=1000000,max_points=max_points,interpolators=interpolators)
     ax.plot(sl[:,0],sl[:,1],'r')
 
     # set new streamline to be empty
     usl = ax.plot([],[],'y')
+    # Reuse one buffer for the streamlines of all clicks
+    sl_buf = np.empty((2*max_points-1, 2))
 
     ax.axis('off')  # Turn off the axes
     plt.colorbar(mvel, ax=ax, label='Velocity magnitude (m/day)')
     # Add title and legend
     ax.set_title(name)
     plt.legend(loc='lower right')
+
+    # If the backend supports it, only the new streamline and point are redrawn on clicks,
+    # on top of a cached background of the rest of the figure
+    blit = fig.canvas.supports_blit
+    usl[0].set_animated(blit)
+    user_point[0].set_animated(blit)
+    background = None
+    # Function to cache the background whenever the full figure is drawn
+    def on_draw(event):
+        nonlocal background
+        background = fig.canvas.copy_from_bbox(ax.bbox)
+        ax.draw_artist(usl[0])
+        ax.draw_artist(user_point[0])
+
+    if blit:
+        fig.canvas.mpl_connect('draw_event', on_draw)
     # Function to handle mouse clicks
     def on_click(event):
         if event.inaxes:
@@ -145,11 +213,18 @@ def inspect_basin(n,starting_point=(np.nan,np.nan),speed_threshold=float(config[
             # Get the clicked point
             new_point = (event.xdata, event.ydata)
             # Add a streamline from the new point
-            sl = streamline(X, Y, u_stream, v_stream,[new_point[0], new_point[1]])
+            sl = streamline(x, y, u_stream, v_stream,[new_point[0], new_point[1]],max_points=max_points,interpolators=interpolators,out=sl_buf)
             usl[0].set_data(sl[:,0],sl[:,1])
             # Plot the new point
             user_point[0].set_data([new_point[0]], [new_point[1]])
-            plt.draw()  # Redraw the plot
+            if blit and background is not None:
+                # Redraw only the new streamline and point
+                fig.canvas.restore_region(background)
+                ax.draw_artist(usl[0])
+                ax.draw_artist(user_point[0])
+                fig.canvas.blit(ax.bbox)
+            else:
+                plt.draw()  # Redraw the plot
 
     # Connect the click event to the handler
     cid = fig.canvas.mpl_connect('button_press_event', on_click)
@@ -169,6 +244,30 @@ def inspect_basin(n,starting_point=(np.nan,np.nan),speed_threshold=float(config[
     return new_point
 
 if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Inspect the catchment of each basin.')
+    parser.add_argument('--batch', action='store_true',
+                        help='Compute the streamlines of all basins from the saved starting points in parallel, without plotting.')
+    args = parser.parse_args()
+
+    save_file = config['Paths']['save_file']
+    if os.path.exists(save_file):
+        points = np.genfromtxt(save_file, delimiter=',', skip_header=1)
+    else:
+        points = np.full((len(basins),2), np.nan)
+
+    if args.batch:
+        # Spawn the workers, they load the (lazily opened) data themselves instead of sharing file handles
+        with multiprocessing.get_context('spawn').Pool() as pool:
+            # Hand out basins in spatial (Hilbert curve) order, so each worker reads neighbouring parts of the data
+            order = np.argsort(basins.geometry.hilbert_distance().values)
+            results = pool.starmap(compute_streamline, [(i, points[i]) for i in order])
+        results = [results[j] for j in np.argsort(order)]
+        points = np.array([p for _, p in results], dtype=float)
+        np.savetxt(save_file, points, delimiter=',', header='x,y', comments='')
+        np.savez(config['Paths']['streamline_file'],
+                 **{'basin_{}'.format(i): sl for i, (sl, _) in enumerate(results) if sl is not None})
+        exit()
+
     # Check the current backend
     current_backend = matplotlib.get_backend()
     print(f"Current Matplotlib backend: {current_backend}")
@@ -177,11 +276,15 @@ if __name__ == "__main__":
     if current_backend not in ['Qt5Agg', 'TkAgg', 'MacOSX']:
         print("Switching to an interactive backend...")
         matplotlib.use('TkAgg')  # Switch to a commonly used interactive backend
-    save_file = config['Paths']['save_file']
-    if os.path.exists(save_file):
-        points = np.genfromtxt(save_file, delimiter=',', skip_header=1)
-    else:
-        points = np.full((len(basins),2), np.nan)
-    for i in range(len(basins)):
-        points[i,:] = inspect_basin(i,points[i,:])
-        np.savetxt(save_file, points, delimiter=',', header='x,y', comments='')
\ No newline at end of file
+    # Write the save file with fixed width rows, so each basin's row can be updated in place
+    header = b'x,y\n'
+    row = '%24.16e,%24.16e\n'
+    row_size = len(row % (0, 0))
+    with open(save_file, 'wb') as f:
+        f.write(header)
+        f.writelines((row % tuple(p)).encode() for p in points)
+        for i in range(len(basins)):
+            points[i,:] = inspect_basin(i,points[i,:])
+            f.seek(len(header) + i*row_size)
+            f.write((row % tuple(points[i,:])).encode())
+            f.flush()
@@ -1,53 +1,330 @@
+import math
+from functools import lru_cache
 import numpy as np
 from scipy.interpolate import RegularGridInterpolator
 from scipy.integrate import solve_ivp
 
-def streamline(X, Y, U, V, start_point, t_max=100000, max_points=10000, method='LSODA',normalize_velocity=False):
+try:
+    from numba import njit
+    HAS_NUMBA = True
+except ImportError:  # Fall back to the Cython kernel or SciPy's interpolators
+    HAS_NUMBA = False
+    def njit(*args, **kwargs):
+        return lambda func: func
+
+try:
+    # Compiled with `cythonize -i _bilin.pyx`
+    from _bilin import velocity as _bilin_velocity
+    HAS_BILIN = True
+except ImportError:
+    HAS_BILIN = False
+
+
+@njit(cache=True)
+def _locate(x0, dx, n, x):
+    """Index of the grid cell containing x (clamped to the grid) and the fractional position within it."""
+    f = (x - x0) / dx
+    i = min(max(int(math.floor(f)), 0), n - 2)
+    return i, f - i
+
+
+@njit(cache=True)
+def _bilerp(A, i, j, tx, ty):
+    """Bilinear interpolation of A within cell (i, j)."""
+    return ((1.0 - ty) * ((1.0 - tx) * A[i, j] + tx * A[i, j + 1])
+            + ty * ((1.0 - tx) * A[i + 1, j] + tx * A[i + 1, j + 1]))
+
+
+@njit(cache=True, error_model='numpy')
+def _velocity(U, V, S, x0, dx, y0, dy, x, y):
     """
-    Computes a streamline in both forward and backward directions using SciPy's ODE solver.
+    Bilinearly interpolated velocity at (x, y) on a regular grid.
+
+    Points outside the grid are extrapolated linearly from the nearest cell, like
+    RegularGridInterpolator with fill_value=None. If S is non-empty the velocity is
+    divided by the interpolated S. Returns (0, 0) where the velocity is not finite.
+    """
+    if not (math.isfinite(x) and math.isfinite(y)):
+        return 0.0, 0.0
+    j, tx = _locate(x0, dx, U.shape[1], x)
+    i, ty = _locate(y0, dy, U.shape[0], y)
+    u = _bilerp(U, i, j, tx, ty)
+    v = _bilerp(V, i, j, tx, ty)
+    if S.size:
+        s = _bilerp(S, i, j, tx, ty)
+        u /= s
+        v /= s
+    if not (math.isfinite(u) and math.isfinite(v)):
+        return 0.0, 0.0
+    return u, v
+
+
+# Dormand-Prince RK45 coefficients, as used by SciPy's RK45
+_A21 = 1/5
+_A31, _A32 = 3/40, 9/40
+_A41, _A42, _A43 = 44/45, -56/15, 32/9
+_A51, _A52, _A53, _A54 = 19372/6561, -25360/2187, 64448/6561, -212/729
+_A61, _A62, _A63, _A64, _A65 = 9017/3168, -355/33, 46732/5247, 49/176, -5103/18656
+_B1, _B3, _B4, _B5, _B6 = 35/384, 500/1113, 125/192, -2187/6784, 11/84
+_E1, _E3, _E4, _E5, _E6, _E7 = -71/57600, 71/16695, -71/1920, 17253/339200, -22/525, 1/40
+
+
+@njit(cache=True, error_model='numpy')
+def _integrate(U, V, S, x0, dx, y0, dy, start_x, start_y, t_max, out, rtol=1e-8, atol=1e-6):
+    """
+    Integrate a streamline from (start_x, start_y) over [0, t_max] with an adaptive RK45 scheme.
+
+    A negative t_max integrates backward. The solution is sampled at len(out) evenly
+    spaced times using cubic Hermite interpolation between steps, and written to the
+    Nx2 array out. Returns the number of points written, which is smaller if the step
+    size underflows or the solution is not finite.
+    """
+    n_points = out.shape[0]
+    sign = 1.0 if t_max >= 0 else -1.0
+    T = abs(t_max)
+    t_step = T / (n_points - 1) if n_points > 1 else T
+
+    x, y = start_x, start_y
+    fx, fy = _velocity(U, V, S, x0, dx, y0, dy, x, y)
+    fx *= sign
+    fy *= sign
+    out[0, 0] = x
+    out[0, 1] = y
+    k = 1
+
+    # Initial step size, following SciPy's select_initial_step
+    sx = atol + abs(x) * rtol
+    sy = atol + abs(y) * rtol
+    d0 = math.sqrt(((x / sx)**2 + (y / sy)**2) / 2)
+    d1 = math.sqrt(((fx / sx)**2 + (fy / sy)**2) / 2)
+    h0 = 1e-6 if d0 < 1e-5 or d1 < 1e-5 else 0.01 * d0 / d1
+    h0 = min(h0, T)
+    gx, gy = _velocity(U, V, S, x0, dx, y0, dy, x + h0 * fx, y + h0 * fy)
+    d2 = math.sqrt((((sign * gx - fx) / sx)**2 + ((sign * gy - fy) / sy)**2) / 2) / h0
+    if max(d1, d2) <= 1e-15:
+        h1 = max(1e-6, h0 * 1e-3)
+    else:
+        h1 = (0.01 / max(d1, d2))**0.2
+    h = min(100 * h0, h1)
+
+    t = 0.0
+    step_rejected = False
+    while k < n_points:
+        t_new = t + h
+        if t_new >= T:
+            t_new = T
+            h = T - t
+        if h <= 10 * np.spacing(t):
+            break  # Step size underflow
+
+        k2x, k2y = _velocity(U, V, S, x0, dx, y0, dy,
+                             x + h * _A21 * fx,
+                             y + h * _A21 * fy)
+        k2x *= sign
+        k2y *= sign
+        k3x, k3y = _velocity(U, V, S, x0, dx, y0, dy,
+                             x + h * (_A31 * fx + _A32 * k2x),
+                             y + h * (_A31 * fy + _A32 * k2y))
+        k3x *= sign
+        k3y *= sign
+        k4x, k4y = _velocity(U, V, S, x0, dx, y0, dy,
+                             x + h * (_A41 * fx + _A42 * k2x + _A43 * k3x),
+                             y + h * (_A41 * fy + _A42 * k2y + _A43 * k3y))
+        k4x *= sign
+        k4y *= sign
+        k5x, k5y = _velocity(U, V, S, x0, dx, y0, dy,
+                             x + h * (_A51 * fx + _A52 * k2x + _A53 * k3x + _A54 * k4x),
+                             y + h * (_A51 * fy + _A52 * k2y + _A53 * k3y + _A54 * k4y))
+        k5x *= sign
+        k5y *= sign
+        k6x, k6y = _velocity(U, V, S, x0, dx, y0, dy,
+                             x + h * (_A61 * fx + _A62 * k2x + _A63 * k3x + _A64 * k4x + _A65 * k5x),
+                             y + h * (_A61 * fy + _A62 * k2y + _A63 * k3y + _A64 * k4y + _A65 * k5y))
+        k6x *= sign
+        k6y *= sign
+        x_new = x + h * (_B1 * fx + _B3 * k3x + _B4 * k4x + _B5 * k5x + _B6 * k6x)
+        y_new = y + h * (_B1 * fy + _B3 * k3y + _B4 * k4y + _B5 * k5y + _B6 * k6y)
+        k7x, k7y = _velocity(U, V, S, x0, dx, y0, dy, x_new, y_new)
+        k7x *= sign
+        k7y *= sign
+
+        # Error estimate relative to the tolerances
+        ex = h * (_E1 * fx + _E3 * k3x + _E4 * k4x + _E5 * k5x + _E6 * k6x + _E7 * k7x)
+        ey = h * (_E1 * fy + _E3 * k3y + _E4 * k4y + _E5 * k5y + _E6 * k6y + _E7 * k7y)
+        sx = atol + max(abs(x), abs(x_new)) * rtol
+        sy = atol + max(abs(y), abs(y_new)) * rtol
+        err = math.sqrt(((ex / sx)**2 + (ey / sy)**2) / 2)
+
+        if not math.isfinite(err):
+            break  # The solution is not finite, stop here
+        if err >= 1.0:
+            # Reject the step and retry with a smaller one
+            h *= max(0.2, 0.9 * err**-0.2)
+            step_rejected = True
+            continue
+
+        # Sample the accepted step at the requested times
+        while k < n_points and (k * t_step <= t_new or t_new == T):
+            theta = (min(k * t_step, T) - t) / h
+            h00 = (1 + 2 * theta) * (1 - theta)**2
+            h10 = theta * (1 - theta)**2
+            h01 = theta**2 * (3 - 2 * theta)
+            h11 = theta**2 * (theta - 1)
+            out[k, 0] = h00 * x + h10 * h * fx + h01 * x_new + h11 * h * k7x
+            out[k, 1] = h00 * y + h10 * h * fy + h01 * y_new + h11 * h * k7y
+            k += 1
+
+        t = t_new
+        x, y = x_new, y_new
+        fx, fy = k7x, k7y
+        factor = 10.0 if err == 0 else min(10.0, 0.9 * err**-0.2)
+        if step_rejected:
+            # Do not grow the step right after a rejection
+            factor = min(1.0, factor)
+            step_rejected = False
+        h *= factor
+
+    return k
+
+
+@njit(cache=True)
+def _streamline(U, V, S, x0, dx, y0, dy, start_x, start_y, t_max, n_points, out, rtol=1e-8, atol=1e-6):
+    """
+    Backward and forward streamline through (start_x, start_y), written along the flow to the
+    Nx2 array out, which must hold 2*n_points-1 points. Returns the number of points written.
+    """
+    # Integrate backward and reverse in place
+    n_bwd = _integrate(U, V, S, x0, dx, y0, dy, start_x, start_y, -t_max, out[:n_points], rtol, atol)
+    for i in range(n_bwd // 2):
+        for c in range(2):
+            out[i, c], out[n_bwd - 1 - i, c] = out[n_bwd - 1 - i, c], out[i, c]
+    # Integrate forward from the start point, which is the last backward point
+    n_fwd = _integrate(U, V, S, x0, dx, y0, dy, start_x, start_y, t_max, out[n_bwd - 1:n_bwd - 1 + n_points], rtol, atol)
+    return n_bwd + n_fwd - 1
+
+
+@lru_cache(maxsize=8)
+def _t_eval(t_max, max_points):
+    """Evenly spaced evaluation times, cached between calls with the same settings."""
+    t_eval = np.linspace(0, t_max, max_points)
+    t_eval.flags.writeable = False
+    return t_eval
+
+
+def make_interpolators(x, y, U, V, normalize_velocity=False):
+    """
+    Prepares the velocity field for interpolation in streamline().
+
+    Parameters:
+    - x, y: 1-D grid coordinates.
+    - U, V: Velocity field components.
+    - normalize_velocity: Normalizes the interpolated velocity field.
+
+    Returns:
+    - Tuple to pass as the interpolators argument of streamline().
+    """
+    if HAS_NUMBA or HAS_BILIN:
+        # Interpolate with a compiled kernel, the grid is assumed to be regular
+        grid = (x[0], x[1] - x[0], y[0], y[1] - y[0])
+        U = np.ascontiguousarray(U)
+        V = np.ascontiguousarray(V, dtype=U.dtype)
+        if normalize_velocity:
+            S = np.sqrt(U**2+V**2)
+        else:
+            S = np.empty((0, 0), dtype=U.dtype)
+        return U, V, S, grid
+
+    # Create a single interpolator for the stacked velocity components (and speed if normalizing)
+    fields = [U, V, np.sqrt(U**2+V**2)] if normalize_velocity else [U, V]
+    UV_interp = RegularGridInterpolator((y, x), np.stack(fields, axis=-1), bounds_error=False, fill_value=None)
+    return UV_interp, normalize_velocity
+
+
+def streamline(x, y, U, V, start_point, t_max=100000, max_points=10000, method=None,normalize_velocity=False,rtol=1e-8,atol=1e-6,interpolators=None,out=None):
+    """
+    Computes a streamline in both forward and backward directions.
     
     Parameters:
-    - X, Y: Meshgrid of coordinates.
+    - x, y: 1-D grid coordinates.
     - U, V: Velocity field components.
     - start_point: Tuple (x, y) of the seed location.
     - t_max: Maximum integration time.
     - max_points: Maximum number of points in each direction.
-    - method: ODE solver method (e.g., 'RK45', 'RK23', 'LSODA').
+    - method: SciPy ODE solver method (e.g., 'RK45', 'RK23', 'LSODA'). If None, a compiled RK45
+      integrator is used when numba is available, otherwise SciPy's LSODA.
     - normalize_velocity: Normalizes the interpolated velocity field. This effectivly changes the time integrant to a distance
+    - rtol, atol: Relative and absolute tolerance of the ODE solver. The relative tolerance applies to the
+      projected coordinates, so it must be small for streamlines far from the origin.
+    - interpolators: Output of make_interpolators for this velocity field. Pass it to reuse the
+      interpolators across calls, normalize_velocity is then ignored.
+    - out: Preallocated (2*max_points-1)x2 array to write the streamline to. Reuse it between calls to
+      avoid allocating a new array for each streamline, the returned array is a view into it.
 
     Matplotlib streamline seems to use LSODA for integration
     
     Returns:
     - Nx2 NumPy array of (x, y) streamline points, ready for plotting.
     """
-    # Create interpolators for velocity field
-    U_interp = RegularGridInterpolator((Y[:, 0], X[0, :]), U, bounds_error=False, fill_value=None)
-    V_interp = RegularGridInterpolator((Y[:, 0], X[0, :]), V, bounds_error=False, fill_value=None)
-    if normalize_velocity:
-        normalizer = RegularGridInterpolator((Y[:, 0], X[0, :]), np.sqrt(U**2+V**2), bounds_error=False, fill_value=None)
-    else:
-        normalizer = lambda xy : 1.0 # always return 1.0
+    if not np.all(np.isfinite(start_point)):
+        raise ValueError("All components of the initial state y0 must be finite.")
 
-    def velocity_field(t, xy):
-        """Velocity field function for ODE solver."""
-        x, y = xy
-        uv = np.array([U_interp((y, x))/normalizer((y,x)), V_interp((y, x))/normalizer((y,x))])
-        return uv if np.all(np.isfinite(uv)) else [0, 0]  # Stop if out of bounds
+    if interpolators is None:
+        interpolators = make_interpolators(x, y, U, V, normalize_velocity)
+    if out is None:
+        out = np.empty((2*max_points-1, 2))
+    elif out.ndim != 2 or out.shape[0] < 2*max_points-1 or out.shape[1] != 2:
+        raise ValueError("out must have shape ({}, 2) or more rows, got {}.".format(2*max_points-1, out.shape))
+
+    if HAS_NUMBA or HAS_BILIN:
+        U, V, S, grid = interpolators
+        if HAS_NUMBA and method is None:
+            # Integrate both directions entirely in compiled code
+            n = _streamline(U, V, S, *grid, start_point[0], start_point[1], t_max, max_points, out, rtol, atol)
+            return out[:n]
+        velocity = _velocity if HAS_NUMBA else _bilin_velocity
+
+        def velocity_field(t, xy):
+            """Velocity field function for ODE solver."""
+            return velocity(U, V, S, *grid, xy[0], xy[1])
+    else:
+        UV_interp, normalized = interpolators
+        # Evaluate the (y, x) point as a 1-D array, which skips broadcasting a tuple of scalars
+        if normalized:
+            def velocity_field(t, xy):
+                """Velocity field function for ODE solver, divided by the interpolated speed."""
+                uvs = UV_interp(xy[::-1])[0]
+                u_val = float(uvs[0]/uvs[2])
+                v_val = float(uvs[1]/uvs[2])
+                if not (math.isfinite(u_val) and math.isfinite(v_val)):
+                    return (0.0, 0.0)  # Stop if out of bounds
+                return (u_val, v_val)
+        else:
+            def velocity_field(t, xy):
+                """Velocity field function for ODE solver."""
+                uv = UV_interp(xy[::-1])[0]
+                u_val = float(uv[0])
+                v_val = float(uv[1])
+                if not (math.isfinite(u_val) and math.isfinite(v_val)):
+                    return (0.0, 0.0)  # Stop if out of bounds
+                return (u_val, v_val)
 
+    if method is None:
+        method = 'LSODA'
 
     # Time evaluation points
-    t_eval_fwd = np.linspace(0, t_max, max_points)    # Forward: Increasing time
-    t_eval_bwd = np.linspace(0, -t_max, max_points)   # Backward: Decreasing time
+    t_eval_fwd = _t_eval(t_max, max_points)     # Forward: Increasing time
+    t_eval_bwd = _t_eval(-t_max, max_points)    # Backward: Decreasing time
 
     # Forward integration (t = 0 to t_max)
-    sol_fwd = solve_ivp(velocity_field, [0, t_max], start_point, method=method, t_eval=t_eval_fwd)
-    fwd_points = np.column_stack((sol_fwd.y[0], sol_fwd.y[1]))
+    sol_fwd = solve_ivp(velocity_field, [0, t_max], start_point, method=method, t_eval=t_eval_fwd, rtol=rtol, atol=atol)
 
     # Backward integration (t = 0 to -t_max)
-    sol_bwd = solve_ivp(velocity_field, [0, -t_max], start_point, method=method, t_eval=t_eval_bwd)
-    bwd_points = np.column_stack((sol_bwd.y[0], sol_bwd.y[1]))
+    sol_bwd = solve_ivp(velocity_field, [0, -t_max], start_point, method=method, t_eval=t_eval_bwd, rtol=rtol, atol=atol)
 
     # Combine backward and forward paths (excluding duplicate start point)
-    streamline_points = np.vstack((bwd_points[::-1], fwd_points[1:]))  # Reverse backward and merge
+    n_bwd = sol_bwd.y.shape[1]
+    n = n_bwd + sol_fwd.y.shape[1] - 1
+    out[:n_bwd] = sol_bwd.y.T[::-1]  # Reverse backward and merge
+    out[n_bwd:n] = sol_fwd.y.T[1:]
 
-    return streamline_points  # Nx2 NumPy array
+    return out[:n]  # Nx2 NumPy array